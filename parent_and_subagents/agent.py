@@ -1,183 +1,100 @@
 
 import os
+import functools
 import logging
-import google.cloud.logging
+from typing import AsyncGenerator
+from pydantic import BaseModel, Field, ValidationError
 from dotenv import load_dotenv
-from .callback_logging import log_query_to_model, log_model_response
+from .callback_logging import enable_cloud_logging, log_query_to_model, log_model_response
+from .plan_cache import PlanCache
 from google.adk import Agent
-from google.adk.agents import SequentialAgent, LoopAgent
+from google.adk.agents import BaseAgent, SequentialAgent, LoopAgent
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.agents.readonly_context import ReadonlyContext
+from google.adk.models import LlmRequest, LlmResponse
 from google.adk.tools.tool_context import ToolContext
-from google.adk.tools import exit_loop
+from google.adk.events import Event, EventActions
 from google.genai import types
 
-cloud_logging_client = google.cloud.logging.Client()
-cloud_logging_client.setup_logging()
+logger = logging.getLogger(__name__)
 
-load_dotenv()
+# Skip parsing .env when the deployment already provides the config. This skips
+# every .env value, GOOGLE_API_KEY included, so an environment that sets MODEL
+# must also set the API key itself.
+if "MODEL" not in os.environ:
+    load_dotenv()
 model_name = os.getenv("MODEL", "gemini-2.5-pro")
-print(model_name)
+# A module logger: logging.debug() would call basicConfig() on import and
+# install a stderr handler on the root logger.
+logger.debug("model=%s", model_name)
 
-def append_to_state(tool_context: ToolContext, field: str, response: str) -> dict[str, str]:
-    existing_state = tool_context.state.get(field, [])
-    tool_context.state[field] = existing_state + [response]
-    logging.info(f"[Added to {field}] {response}")
-    return {"status": "success"}
-def get_latest_state(tool_context: ToolContext) -> dict[str, str]:
-    """
-    Extracts the latest code draft and feedback from the shared state.
-    Ensures each iteration works on the most recent version only.
-    """
-    drafts = tool_context.state.get("CODE_DRAFT", [])
-    feedbacks = tool_context.state.get("CRITICAL_FEEDBACK", [])
+# Ceiling against runaway decodes. It must cover the longest draft (~4K tokens),
+# the critique, the JSON wrapping and, on gemini-2.5 models, thinking tokens.
+WRITER_MAX_OUTPUT_TOKENS = 32768
 
-    latest_draft = drafts[-1] if drafts else ""
-    latest_feedback = feedbacks[-1] if feedbacks else ""
+# Tool-facing field names and the state keys their readers use. Only the
+# greeter has set_state; ReviewGate writes the draft and critique itself.
+_STATE_KEYS = {
+    "PROMPT": "latest_prompt",
+}
 
-    logging.info("[State Sync] Using latest CODE_DRAFT and CRITICAL_FEEDBACK.")
-    return {
-        "latest_code_draft": latest_draft,
-        "latest_feedback": latest_feedback
-    }
-
-def handoff_to(tool_context: ToolContext, agent_name: str) -> dict[str, str]:
+def set_state(tool_context: ToolContext, field: str, response: str) -> dict[str, str]:
     """
-    Explicitly transfers control to the named sub-agent inside the current parent.
-    Used to enforce deterministic next-step routing (e.g., writer → critic).
+    Stores response as the current value of field, replacing any previous
+    value. The only field is PROMPT: the complete description of the agent
+    to build.
     """
-    logging.info(f"[handoff_to] Transferring to agent: {agent_name}")
-    return {"transfer_to_agent": {"agent_name": agent_name}}
-
-code_critic = Agent(
-    name="code_critic",
-    model=model_name,
-    description="Reviews the latest code draft and provides actionable feedback for improvement.",
-    instruction="""
-CODE_DRAFT:
-{ latest_code_draft? }
-
-INSTRUCTIONS:
-- Review the latest draft from CODE_DRAFT.
-- Validate:
-  1) Syntax and imports (compiles cleanly)
-  2) ADK structure (Agents, tools, Loop/Sequential flow)
-  3) Runnable standalone script (env setup, logging)
-  4) Clear docstrings / no extraneous prose
-  5) No duplicate code blocks
-
-BEHAVIOR RULES:
-- If you are mistakely called first sent user prompt as feedback to writer agent using Append CRITICAL_FEEDBACK
-- If improvement is needed:
-  * Append CRITICAL_FEEDBACK with specific, concise actions.
-  * Then call handoff_to("code_writer").
-  When Maximam Iterations reached exit the loop
-- Never respond to the user or other peers.
-""",
-    before_model_callback=log_query_to_model,
-    after_model_callback=log_model_response,
-    tools=[get_latest_state, append_to_state, handoff_to],
-    disallow_transfer_to_parent=True,   # stay within loop, no fallback to greeter
-)
-
-code_writer = Agent(
-    name="code_writer",
-    model=model_name,
-    description="Writes or refines Python ADK code using the most recent critique feedback.",
-    instruction="""
-PROMPT:
-{ PROMPT? }
+    key = _STATE_KEYS.get(field.upper())
+    if key is None:
+        return {"status": "error", "message": f"Unknown field {field!r}; expected {' or '.join(_STATE_KEYS)}."}
+    # Sync tools run one at a time on the event-loop thread, so this plain
+    # assignment needs no lock. Two calls for the same field in one turn still
+    # overwrite each other: the last write wins.
+    tool_context.state[key] = response
+    logging.info("[Set %s] %s", field, response)
+    return {"status": "success"}
 
-CODE_DRAFT:
-{ latest_code_draft? }
+# Static instruction text is built once at import; providers below only splice
+# in the current state, so ADK does not re-scan the template on every call.
+_CODE_WRITER_CRITIC_INSTRUCTIONS = """
+The current PROMPT, CODE_DRAFT and CRITICAL_FEEDBACK are given in the <state> block at the end.
 
-CRITICAL_FEEDBACK:
-{ latest_feedback? }
+You write Python ADK code and critique your own draft in the same turn.
 
-INSTRUCTIONS:
--Never transfer control to parent agent, Always transfer control to code_critic agent using handoff tool this is critical do not forgot that.
-- You are the **Code Writer** in a refinement loop.
-- Always read and apply the most recent feedback from the code_critic agent stored in CRITICAL_FEEDBACK before writing new code.
-- If no feedback exists, generate the first version from PROMPT.
-- If feedback exists, revise ONLY the most recent draft based on it.
-- Append the new code to CODE_DRAFT  using append_to_state.
-- Then call handoff_to("code_critic") to continue the loop.
-- Always call handoff_to("code_critic") to continue the loop when necessary so that loop execute sucessfully we do not wated to transfer control to rool agent once you receive prompt from it remember it
--Never transfer control to parent agent, Always transfer control to code_critic agent using handoff tool this is critical do not forgot that.
-- Never produce prose or explanations, only pure code.
-- Do not exit or call peers other than code_critic.
-- Never call peers other than code_critic, and never speak to the user.
-- Always include necessary imports, environment setup, and comments if needed inside the code.
--Only use the tools that we have described not any other tool remeber that
-
-When you describe your idea, I’ll interpret it using the following ADK framework guidelines:
-
-1. **Agent Types:**
-   - **Root Agent:** Handles user input and orchestrates other agents.
-   - **SequentialAgent:** Runs sub-agents in a defined order (pipeline-style).
-   - **LoopAgent:** Iterates between agents (for iterative improvements or feedback loops).
-   - **Tool Agent:** Wraps utility functions like reading/writing files, appending state, etc.
-
-2. **Core Imports:**
-   - `from google.adk import Agent`
-   - `from google.adk.agents import SequentialAgent, LoopAgent`
-   - `from google.adk.tools import exit_loop`
-   - `from google.adk.tools.tool_context import ToolContext`
-   - `from google.genai import types`
-   - `from dotenv import load_dotenv`
-   - `import os, logging, google.cloud.logging`
-
-3. **Environment Variables:**
-   - MODEL → Which Gemini model to use (e.g. gemini-2.5-pro)
-   - GOOGLE_API_KEY → Required API key
-   - Additional optional config (like USE_VERTEX or TEMPERATURE)
-
-4. **Coding Conventions:**
-   - Always define `append_to_state()` for tool-based state persistence.
-   - Use structured prompts with sections like PROMPT, CODE_DRAFT, CRITICAL_FEEDBACK and CRITICAL_FEEDBACK.
-   - Always log queries and responses with `before_model_callback` and `after_model_callback`.
-   - Never use async; keep all code synchronous like the Loop Agent reference.
-
-5. **Output Requirements:**
-   - The final output must be Python code only, enclosed in fenced code blocks (```python ... ```).
-   - No prose explanations — only runnable code.
-   - Use consistent indentation and explicit imports.
-- Behavior rules:
-  1. If PROMPT exists and no CODE_DRAFT exists → generate initial implementation.
-  2. If CRITICAL_FEEDBACK exists → revise the latest CODE_DRAFT accordingly.
-  3. Append your complete code to 'CODE_DRAFT' using append_to_state.
-  4. Then **transfer control** to the `code_critic` agent for review.
-  5. Do NOT end the loop or exit yourself — let code_critic decide when to stop.
-  6.After writing the draft, return control to the loop controller (do NOT call peers, do NOT talk to the user).
 BEHAVIOR RULES:
-1️⃣ If first iteration → generate initial code.
-2️⃣ If CRITICAL_FEEDBACK exists → revise last draft.
-3️⃣ Append final code to CODE_DRAFT.
-4️⃣ Call handoff_to("code_critic").
-5️⃣ Never call exit_loop or interact with the user.
+1. If there is no CODE_DRAFT, write the first version from PROMPT.
+2. Otherwise revise only the latest CODE_DRAFT, applying every point in CRITICAL_FEEDBACK.
+3. Review the new draft for:
+   - syntax and imports (compiles cleanly)
+   - ADK structure (agents, tools, Loop/Sequential flow)
+   - a runnable standalone script (env setup, logging)
+   - clear docstrings, no extraneous prose, no duplicate code blocks
+4. Never transfer to the parent agent or speak to the user.
 
 OUTPUT FORMAT:
-Output raw Python code only (no markdown fences).
-""",
-    before_model_callback=log_query_to_model,
-    after_model_callback=log_model_response,
-    tools=[get_latest_state, append_to_state, handoff_to],
-    disallow_transfer_to_parent=True,   # keeps control within dev_loop
-)
-
-
-
-dev_loop = LoopAgent(
-    name="dev_loop",
-    description="Starts always from code_writer and Iterates between code_writer and code_critic.",
-    sub_agents=[code_writer, code_critic],
-    max_iterations=5, 
-)
-final_presenter = Agent(
-    name="final_presenter",
-    model=model_name,
-    description="Outputs final improved code as text.",
-    instruction="""
-CODE_DRAFT:
-{ latest_code_draft? }
+Respond with a JSON object:
+- code: the complete draft as raw Python code (no markdown fences, no prose). Include
+  all imports and environment setup; put any comments inside the code.
+- critique: at most five short bullet points of fixes still needed; empty if none.
+- done: true only when the review found nothing left to fix.
+"""
+
+# Framework knowledge, only needed while writing the first draft.
+_ADK_REFERENCE = """
+ADK REFERENCE:
+- Agent types: Agent (LLM agent), SequentialAgent (runs sub-agents in order),
+  LoopAgent (repeats sub-agents until exit_loop or max_iterations).
+- Imports: `from google.adk import Agent`, `from google.adk.agents import SequentialAgent, LoopAgent`,
+  `from google.adk.tools import exit_loop`, `from google.adk.tools.tool_context import ToolContext`,
+  `from google.genai import types`, `from dotenv import load_dotenv`.
+- Environment: MODEL (Gemini model, e.g. gemini-2.5-pro), GOOGLE_API_KEY (required).
+- Conventions: persist state with an append_to_state() tool, log model traffic with
+  before_model_callback / after_model_callback, keep all code synchronous.
+"""
+
+_FINAL_PRESENTER_INSTRUCTIONS = """
+The current CODE_DRAFT is given in the <state> block at the end.
 
 INSTRUCTIONS:
 - Consolidate and refine the final code draft.
@@ -186,38 +103,279 @@ INSTRUCTIONS:
 # final code
 \\`\\`\\`
 No explanations or commentary.
-""",
-    generate_content_config=types.GenerateContentConfig(temperature=0),
-    disallow_transfer_to_parent=True,
-disallow_transfer_to_peers=True,
-
+"""
+
+def _state_block(**sections: str) -> str:
+    # Volatile state always goes last so the static prefix stays byte-identical
+    # across turns and can be served from the provider's prompt cache.
+    body = "\n\n".join(f"{name}:\n{value}" for name, value in sections.items())
+    return "\n<state>\n" + body + "\n</state>\n"
+
+def code_writer_critic_instruction(context: ReadonlyContext) -> str:
+    draft = context.state.get("latest_code_draft", "")
+    # Revisions work from an existing draft; skip re-prefilling the reference.
+    # A retry after an unusable first response has feedback but still no draft.
+    reference = "" if draft else _ADK_REFERENCE
+    return _CODE_WRITER_CRITIC_INSTRUCTIONS + reference + _state_block(
+        PROMPT=context.state.get("latest_prompt", ""),
+        CODE_DRAFT=draft,
+        CRITICAL_FEEDBACK=context.state.get("latest_feedback", ""),
+    )
+
+def final_presenter_instruction(context: ReadonlyContext) -> str:
+    return _FINAL_PRESENTER_INSTRUCTIONS + _state_block(
+        CODE_DRAFT=context.state.get("latest_code_draft", ""),
+    )
+
+class WriterOutput(BaseModel):
+    code: str = Field(description="Complete raw Python code for the current draft.")
+    critique: str = Field(description="At most five short bullet points of fixes still needed; empty if none.")
+    done: bool = Field(description="True when the review found nothing left to fix.")
+
+_RETRY_FEEDBACK = (
+    "- Your previous response was cut off or was not valid JSON. Return the "
+    "complete draft again, more compactly if needed."
 )
-builder_team = SequentialAgent(
-    name="builder_team",
-    description="Runs the dev loop and final presenter.",
-    sub_agents=[dev_loop, final_presenter],
-    
 
-)
+def recover_invalid_writer_output(
+    callback_context: CallbackContext, llm_response: LlmResponse
+) -> LlmResponse | None:
+    """
+    Replaces a truncated (MAX_TOKENS) or malformed writer response with a valid
+    WriterOutput that carries no code and asks for a retry. Without this the
+    output_key schema validation raises and aborts the whole run.
+    """
+    if llm_response.partial or not llm_response.content or not llm_response.content.parts:
+        return None
+    text = "".join(part.text for part in llm_response.content.parts if part.text and not part.thought)
+    truncated = llm_response.finish_reason == types.FinishReason.MAX_TOKENS
+    if not text and not truncated:
+        return None
+    if not truncated:
+        try:
+            WriterOutput.model_validate_json(text)
+            return None
+        except ValidationError:
+            pass
+    logging.warning("[%s] unusable response (truncated=%s); asking for a retry.", callback_context.agent_name, truncated)
+    retry = WriterOutput(code="", critique=_RETRY_FEEDBACK, done=False)
+    return llm_response.model_copy(update={
+        "content": types.Content(role="model", parts=[types.Part(text=retry.model_dump_json())]),
+    })
+
+def drop_previous_writer_outputs(
+    callback_context: CallbackContext, llm_request: LlmRequest
+) -> LlmResponse | None:
+    """
+    Removes the writer's earlier JSON outputs from the request. The <state>
+    block already carries the latest draft and critique, and include_contents
+    "none" still replays this invocation's previous loop turns.
+    """
+    llm_request.contents = [content for content in llm_request.contents if content.role != "model"]
+    return None
+
+class ReviewGate(BaseAgent):
+    """
+    Records the structured WRITER_OUTPUT as latest_code_draft / latest_feedback and
+    escalates out of dev_loop as soon as the draft has converged: the review
+    passed, left nothing to fix, or the draft came back unchanged. Only the
+    first two set review_passed. A turn without code keeps the previous draft
+    and only forwards the critique. Runs without an LLM call.
+    """
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        state = ctx.session.state
+        output = state.get("WRITER_OUTPUT") or {}
+        code = output.get("code", "")
+        critique = output.get("critique", "")
+        if code.strip():
+            passed = bool(output.get("done")) or not critique.strip()
+            done = passed or code.strip() == state.get("latest_code_draft", "").strip()
+            state_delta = {
+                "latest_code_draft": code,
+                "latest_feedback": critique,
+                "review_passed": passed,
+            }
+        else:
+            done = False
+            state_delta = {"latest_feedback": critique, "review_passed": False}
+        logging.info("[%s] done=%s feedback=%s", self.name, done, critique)
+        yield Event(
+            invocation_id=ctx.invocation_id,
+            author=self.name,
+            branch=ctx.branch,
+            actions=EventActions(state_delta=state_delta, escalate=done),
+        )
+
+def _presentable(code: str) -> str | None:
+    """
+    Returns the draft as a fenced python block when it can be shown verbatim,
+    or None when it still needs an LLM pass to clean up.
+    """
+    code = code.strip()
+    if not code:
+        return None
+    if code.startswith("```python"):
+        return code
+    try:
+        compile(code, "<CODE_DRAFT>", "exec")
+    except (SyntaxError, ValueError):
+        return None
+    return f"```python\n{code}\n```"
+
+class FinalPresenter(BaseAgent):
+    """
+    Presents latest_code_draft. A draft that is already fenced or compiles
+    as-is is emitted directly; only malformed drafts go through the LLM
+    presenter in sub_agents[0].
+    """
 
-root_agent = Agent(
-    name="greeter",
-    model=model_name,
-    description="Greets the user and starts the code generator process.",
-    instruction="""
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        presented = _presentable(ctx.session.state.get("latest_code_draft", ""))
+        if presented is None:
+            async for event in self.sub_agents[0].run_async(ctx):
+                yield event
+            return
+        yield Event(
+            invocation_id=ctx.invocation_id,
+            author=self.name,
+            branch=ctx.branch,
+            content=types.Content(role="model", parts=[types.Part(text=presented)]),
+        )
+
+_plan_cache = PlanCache()
+
+def _plan_key(callback_context: CallbackContext) -> str:
+    # The user's message for this invocation, qualified by the PROMPT the
+    # greeter recorded, so a stale PROMPT or a bare "go ahead" cannot collide.
+    content = callback_context.user_content
+    request = "".join(part.text for part in content.parts if part.text) if content and content.parts else ""
+    if not request.strip():
+        return ""
+    return callback_context.state.get("latest_prompt", "") + "\n" + request
+
+def reuse_cached_plan(callback_context: CallbackContext) -> types.Content | None:
+    """
+    Starts every request from a clean draft, then skips dev_loop when the same
+    request already produced a final draft in this process; the cached draft
+    is placed in latest_code_draft for final_presenter.
+    """
+    state = callback_context.state
+    # Per-request keys persist in the session; a new request must not revise
+    # the previous request's draft.
+    state["latest_code_draft"] = ""
+    state["latest_feedback"] = ""
+    state["review_passed"] = False
+    state["WRITER_OUTPUT"] = None
+    key = _plan_key(callback_context)
+    draft = _plan_cache.get(key) if key else None
+    if draft is None:
+        return None
+    state["latest_code_draft"] = draft
+    logging.info("[plan cache] Reusing cached draft for this request.")
+    return types.Content(role="model", parts=[types.Part(text="Reusing a cached draft for this request.")])
+
+def store_plan(callback_context: CallbackContext) -> None:
+    """
+    Caches the final draft of dev_loop when its review passed and it can be
+    presented as-is; a draft left over at max_iterations is not cached.
+    """
+    state = callback_context.state
+    if not state.get("review_passed"):
+        return
+    key = _plan_key(callback_context)
+    draft = state.get("latest_code_draft", "")
+    if key and _presentable(draft) is not None:
+        _plan_cache.put(key, draft)
+
+_GREETER_INSTRUCTIONS = """
 Welcome! I’ll help you generate **Python code for a new ADK Agent system.**
 
 Please describe the agent you want to build — include its purpose, input/output behavior, 
 and any specific logic you want (like using Gemini, file tools, or custom callbacks).
 
-Transfer the findings by using tools to builder team
+When the user has described the agent, call set_state("PROMPT", <the complete description>)
+and then transfer to builder_team. Do this for every new request.
 
 Once you describe your agent idea, I’ll translate it into a complete ADK-compatible implementation using these standards.
-""",
-    tools=[get_latest_state, append_to_state],
-    sub_agents=[builder_team],
-    disallow_transfer_to_parent=True,
-disallow_transfer_to_peers=True,
-
-)
+"""
 
+@functools.cache
+def build_root_agent() -> Agent:
+    """
+    Builds the greeter -> builder_team agent tree once per process.
+    Every caller (ADK loader, tests, notebooks) shares the same instances.
+    """
+    # Drafting and review share the same model and context, so they run as one
+    # agent turn instead of alternating writer/critic round-trips.
+    code_writer_critic = Agent(
+        name="code_writer_critic",
+        model=model_name,
+        description="Writes or refines Python ADK code and critiques the new draft in the same turn.",
+        instruction=code_writer_critic_instruction,
+        # Everything the writer needs is in the <state> block of its instruction.
+        include_contents="none",
+        before_model_callback=[log_query_to_model, drop_previous_writer_outputs],
+        after_model_callback=[log_model_response, recover_invalid_writer_output],
+        # Constrained JSON output replaces the prose tool plan the model kept violating.
+        output_schema=WriterOutput,
+        output_key="WRITER_OUTPUT",
+        generate_content_config=types.GenerateContentConfig(
+            temperature=0.2,
+            top_p=1,
+            max_output_tokens=WRITER_MAX_OUTPUT_TOKENS,
+        ),
+        disallow_transfer_to_parent=True,   # keeps control within dev_loop
+        disallow_transfer_to_peers=True,
+    )
+
+    review_gate = ReviewGate(
+        name="review_gate",
+        description="Stores the latest draft and critique and stops the loop when the review passes.",
+    )
+
+    dev_loop = LoopAgent(
+        name="dev_loop",
+        description="Repeats code_writer_critic until its own review passes.",
+        sub_agents=[code_writer_critic, review_gate],
+        max_iterations=5,
+        before_agent_callback=reuse_cached_plan,
+        after_agent_callback=store_plan,
+    )
+
+    final_presenter_llm = Agent(
+        name="final_presenter_llm",
+        model=model_name,
+        description="Repairs and outputs the final code draft as text.",
+        instruction=final_presenter_instruction,
+        include_contents="none",
+        generate_content_config=types.GenerateContentConfig(temperature=0),
+        disallow_transfer_to_parent=True,
+        disallow_transfer_to_peers=True,
+    )
+
+    final_presenter = FinalPresenter(
+        name="final_presenter",
+        description="Outputs final improved code as text.",
+        sub_agents=[final_presenter_llm],
+    )
+
+    builder_team = SequentialAgent(
+        name="builder_team",
+        description="Runs the dev loop and final presenter.",
+        sub_agents=[dev_loop, final_presenter],
+    )
+
+    return Agent(
+        name="greeter",
+        model=model_name,
+        description="Greets the user and starts the code generator process.",
+        instruction=_GREETER_INSTRUCTIONS,
+        tools=[set_state],
+        sub_agents=[builder_team],
+        before_agent_callback=enable_cloud_logging,
+        disallow_transfer_to_parent=True,
+        disallow_transfer_to_peers=True,
+    )
+
+root_agent = build_root_agent()
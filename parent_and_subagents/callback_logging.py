@@ -1,14 +1,42 @@
+import functools
 import logging
+import google.cloud.logging
 from google.adk.agents.callback_context import CallbackContext
 from google.adk.models import LlmResponse, LlmRequest
 
+@functools.lru_cache(maxsize=1)
+def get_cloud_logging_client() -> google.cloud.logging.Client | None:
+    """
+    Creates the Cloud Logging client on first use instead of at import time.
+    Client construction does credential and metadata-server lookups, which
+    would otherwise block every cold start before the first request.
+    A failed setup (e.g. no credentials) is cached as None, so it is paid once
+    and logging stays local instead of every callback retrying and raising.
+    """
+    try:
+        client = google.cloud.logging.Client()
+        client.setup_logging()
+    except Exception:
+        logging.warning("Cloud Logging unavailable; logging locally only.", exc_info=True)
+        return None
+    return client
+
+def enable_cloud_logging(callback_context: CallbackContext) -> None:
+    """
+    before_agent_callback for the root agent, so Cloud Logging is set up before
+    any agent or tool in the invocation logs, not only the model callbacks.
+    """
+    get_cloud_logging_client()
+
 def log_query_to_model(callback_context: CallbackContext, llm_request: LlmRequest):
+    get_cloud_logging_client()
     if llm_request.contents and llm_request.contents[-1].role == 'user':
         for part in llm_request.contents[-1].parts:
             if part.text:
                 logging.info("[query to %s]: %s", callback_context.agent_name, part.text)
 
 def log_model_response(callback_context: CallbackContext, llm_response: LlmResponse):
+    get_cloud_logging_client()
     if llm_response.content and llm_response.content.parts:
         for part in llm_response.content.parts:
             if part.text:
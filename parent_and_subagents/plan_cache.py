@@ -0,0 +1,34 @@
+import hashlib
+from collections import OrderedDict
+
+PLAN_CACHE_SIZE = 128
+
+class PlanCache:
+    """
+    In-process LRU of final code drafts keyed by a hash of the normalized
+    request text (case and whitespace insensitive), so a repeated request can
+    skip the whole refinement loop.
+    """
+
+    def __init__(self, maxsize: int = PLAN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._plans: OrderedDict[str, str] = OrderedDict()
+
+    @staticmethod
+    def key(request: str) -> str:
+        normalized = " ".join(request.lower().split())
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, request: str) -> str | None:
+        key = self.key(request)
+        draft = self._plans.get(key)
+        if draft is not None:
+            self._plans.move_to_end(key)
+        return draft
+
+    def put(self, request: str, draft: str) -> None:
+        key = self.key(request)
+        self._plans[key] = draft
+        self._plans.move_to_end(key)
+        while len(self._plans) > self.maxsize:
+            self._plans.popitem(last=False)